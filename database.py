@@ -10,11 +10,21 @@ class DatabaseManager:
         self.db_path = db_path
         self.init_database()
     
+    def _connect(self):
+        """Open a connection to the database"""
+        conn = sqlite3.connect(self.db_path)
+        # WAL makes commits cheap; NORMAL only fsyncs at checkpoints in WAL mode
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
     def init_database(self):
         """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        # Write-ahead logging persists in the database file once set
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Create users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -42,7 +52,7 @@ class DatabaseManager:
     
     def add_user(self, name):
         """Add a new user to the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
@@ -58,9 +68,32 @@ class DatabaseManager:
         finally:
             conn.close()
     
+    def add_users(self, names):
+        """Add several users in a single transaction; returns whether each one was added"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            added = []
+            for name in names:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO users (name) VALUES (?)",
+                    (name,)
+                )
+                # rowcount is 0 when the user already exists
+                added.append(cursor.rowcount > 0)
+            conn.commit()
+            return added
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
     def delete_user(self, name):
         """Delete a user from the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute("DELETE FROM users WHERE name = ?", (name,))
@@ -70,7 +103,7 @@ class DatabaseManager:
     
     def get_all_users(self):
         """Retrieve all users from the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute("SELECT id, name, created_at, last_seen, access_count FROM users ORDER BY name")
@@ -81,7 +114,7 @@ class DatabaseManager:
     
     def get_user(self, name):
         """Retrieve a specific user from the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute("SELECT id, name, created_at, last_seen, access_count FROM users WHERE name = ?", (name,))
@@ -92,7 +125,7 @@ class DatabaseManager:
     
     def update_user_access(self, name):
         """Update user's last seen time and increment access count"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -105,7 +138,7 @@ class DatabaseManager:
     
     def log_access_event(self, event_type, person_name=None, details=None):
         """Log an access event to the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -118,7 +151,7 @@ class DatabaseManager:
     
     def get_recent_access_logs(self, limit=50):
         """Retrieve recent access logs"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -132,7 +165,7 @@ class DatabaseManager:
     
     def get_user_access_logs(self, person_name):
         """Retrieve access logs for a specific user"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
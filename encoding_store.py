@@ -0,0 +1,289 @@
+import os
+import json
+import pickle
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl; lock the lock file with msvcrt instead
+    fcntl = None
+    import msvcrt
+try:
+    from sklearn.neighbors import BallTree
+    BALLTREE_AVAILABLE = True
+except ImportError:
+    BALLTREE_AVAILABLE = False
+
+ENCODING_SIZE = 128
+QUANT_LEVELS = 127
+
+def _quantize(encodings):
+    """Quantize (N, 128) float encodings to int8 rows with one float32 scale per row"""
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    scales = np.max(np.abs(encodings), axis=1)
+    scales[scales == 0] = 1.0
+    quantized = np.round(encodings / scales[:, None] * QUANT_LEVELS).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+def _dequant(quantized, scales):
+    """Turn int8 rows and their scales back into float32 encodings"""
+    return quantized.astype(np.float32) * (np.asarray(scales, dtype=np.float32)[..., None] / QUANT_LEVELS)
+
+class EncodingStore:
+    """Stores all face encodings as one (N, 128) int8 matrix with per-row scales plus a parallel list of names"""
+
+    def __init__(self, faces_dir="known_faces"):
+        self.faces_dir = faces_dir
+        # Names, int8 rows and scales live in one .npz, so one os.replace swaps them together
+        self.store_path = os.path.join(faces_dir, "encodings.npz")
+        self.lock_path = os.path.join(faces_dir, "encodings.lock")
+        self.tree_path = os.path.join(faces_dir, "tree.pkl")
+        self.names = []
+        self.quantized = np.empty((0, ENCODING_SIZE), dtype=np.int8)
+        self.scales = np.empty(0, dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._rows = {}  # name -> row index into self.quantized
+        self._tree = None  # BallTree over the dequantized encodings, loaded lazily
+        self._fingerprint = None  # hash of names, rows and scales the tree must match
+        self._stat = None  # (mtime, inode, size) of the store file last loaded
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load the store, migrating older encoding files if there is no store yet"""
+        try:
+            with self._file_lock():
+                self._load_locked()
+        except Exception as e:
+            print(f"Error loading encodings from {self.store_path}: {e}")
+
+    def refresh(self):
+        """Reload if another process (e.g. register.py or another worker) has rewritten the store"""
+        if self._store_stat() != self._stat:
+            self.load()
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold an exclusive lock on the store, across threads and processes"""
+        os.makedirs(self.faces_dir, exist_ok=True)
+        with self._lock, open(self.lock_path, 'a+b') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _store_stat(self):
+        try:
+            st = os.stat(self.store_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def _load_locked(self):
+        """Load the latest store from disk (caller holds the file lock)"""
+        if not os.path.exists(self.store_path):
+            self._migrate_locked()
+            return
+        with np.load(self.store_path) as data:
+            names = data['names'].tolist()
+            quantized = data['quantized']
+            scales = data['scales']
+        self._set(names, quantized, scales)
+        self._stat = self._store_stat()
+
+    def _migrate_locked(self):
+        """Build the store from older encoding files (caller holds the file lock)"""
+        names_path = os.path.join(self.faces_dir, "names.json")
+        matrix_path = os.path.join(self.faces_dir, "encodings.npy")
+        scales_path = os.path.join(self.faces_dir, "encoding_scales.npy")
+
+        if os.path.exists(names_path):
+            # Separate names.json + encodings.npy (+ encoding_scales.npy) layout
+            with open(names_path, 'r') as f:
+                names = json.load(f)
+            matrix = np.load(matrix_path)
+            if matrix.dtype == np.int8:
+                quantized, scales = matrix, np.load(scales_path)
+            else:
+                quantized, scales = _quantize(matrix)
+            self._write(names, quantized, scales)
+            for path in (names_path, matrix_path, scales_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        # Original layout: one {name}_encoding.npy file per user
+        names = []
+        encodings = []
+        for file in sorted(os.listdir(self.faces_dir)):
+            if file.endswith('_encoding.npy'):
+                try:
+                    encodings.append(np.load(os.path.join(self.faces_dir, file)).astype(np.float32))
+                    names.append(file[:-len('_encoding.npy')])
+                except Exception as e:
+                    print(f"Error loading encoding {file}: {e}")
+
+        if names:
+            self._write(names, *_quantize(np.vstack(encodings)))
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def matrix(self):
+        """All encodings dequantized to an (N, 128) float32 matrix, in self.names order"""
+        return _dequant(self.quantized, self.scales)
+
+    def get(self, name):
+        """Return the (dequantized) encoding of a user, or None if the user has no encoding"""
+        row = self._rows.get(name)
+        return None if row is None else _dequant(self.quantized[row], self.scales[row])
+
+    def add(self, name, encoding):
+        """Add or replace the encoding of a user"""
+        self.add_many({name: encoding})
+
+    def add_many(self, encodings):
+        """Add or replace the encodings of several users ({name: encoding}), saving once"""
+        with self._file_lock():
+            # Start from what is on disk, so changes by other processes are kept
+            self._load_locked()
+            names = list(self.names)
+            quantized = self.quantized.copy()
+            scales = self.scales.copy()
+            new_rows = []
+            new_scales = []
+            for name, encoding in encodings.items():
+                q_row, q_scale = _quantize(encoding)
+                if name in self._rows:
+                    row = self._rows[name]
+                    quantized[row], scales[row] = q_row[0], q_scale[0]
+                else:
+                    names.append(name)
+                    new_rows.append(q_row)
+                    new_scales.append(q_scale)
+            if new_rows:
+                quantized = np.vstack([quantized] + new_rows)
+                scales = np.concatenate([scales] + new_scales)
+            self._write(names, quantized, scales)
+
+    def remove(self, name):
+        """Remove the encoding of a user"""
+        return bool(self.remove_many([name]))
+
+    def remove_many(self, names):
+        """Remove the encodings of several users, saving once; returns the names that were removed"""
+        with self._file_lock():
+            self._load_locked()
+            rows = sorted(self._rows[name] for name in set(names) if name in self._rows)
+            if not rows:
+                return []
+            removed = [self.names[row] for row in rows]
+            keep = np.ones(len(self.names), dtype=bool)
+            keep[rows] = False
+            self._write(
+                [name for name, kept in zip(self.names, keep) if kept],
+                self.quantized[keep],
+                self.scales[keep]
+            )
+            return removed
+
+    def face_distance(self, encoding):
+        """Euclidean distance from an encoding to every stored encoding, in self.names order"""
+        encoding = np.asarray(encoding, dtype=np.float32)
+        q_query, q_scale = _quantize(encoding)
+
+        # |x - q|^2 = |x|^2 + |q|^2 - 2 x.q, with x.q taken as an int32 dot product
+        # of the int8 rows and rescaled afterwards
+        dots = np.einsum('ij,j->i', self.quantized, q_query[0], dtype=np.int32, optimize=True)
+        dots = dots * (self.scales * (q_scale[0] / QUANT_LEVELS ** 2))
+        sq_distances = self._sq_norms + np.dot(encoding, encoding) - 2 * dots
+        return np.sqrt(np.maximum(sq_distances, 0))
+
+    def query(self, encoding, k=1):
+        """Return up to k (name, distance) pairs closest to an encoding, nearest first"""
+        k = min(k, len(self.names))
+        if k == 0:
+            return []
+
+        tree = self._get_tree()
+        if tree is None:
+            distances = self.face_distance(encoding)
+            rows = np.argsort(distances)[:k]
+            return [(self.names[row], float(distances[row])) for row in rows]
+
+        distances, rows = tree.query(np.asarray(encoding, dtype=np.float32).reshape(1, ENCODING_SIZE), k=k)
+        return [(self.names[row], float(distance)) for row, distance in zip(rows[0], distances[0])]
+
+    def _get_tree(self):
+        """Load the pickled BallTree, rebuilding it if it is missing or stale"""
+        if not BALLTREE_AVAILABLE:
+            return None
+        if self._tree is None:
+            try:
+                with open(self.tree_path, 'rb') as f:
+                    fingerprint, tree = pickle.load(f)
+                # Same names is not enough: a re-registered user keeps the name but not the row
+                if fingerprint == self._fingerprint:
+                    self._tree = tree
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error loading encoding index {self.tree_path}: {e}")
+        if self._tree is None:
+            self._build_tree()
+        return self._tree
+
+    def _build_tree(self):
+        """Rebuild the BallTree over the current encodings and pickle it next to them"""
+        if not BALLTREE_AVAILABLE or len(self.names) == 0:
+            self._tree = None
+            return
+
+        self._tree = BallTree(self.matrix, metric='euclidean', leaf_size=40)
+        tmp_path = f"{self.tree_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((self._fingerprint, self._tree), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.tree_path)
+
+    def _set(self, names, quantized, scales):
+        self.names = names
+        self.quantized = quantized
+        self.scales = scales
+        encodings = self.matrix
+        self._sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        self._rows = {name: row for row, name in enumerate(names)}
+        fingerprint = hashlib.blake2b(json.dumps(names).encode(), digest_size=16)
+        fingerprint.update(np.ascontiguousarray(quantized).tobytes())
+        fingerprint.update(np.ascontiguousarray(scales, dtype=np.float32).tobytes())
+        self._fingerprint = fingerprint.digest()
+        self._tree = None
+
+    def _write(self, names, quantized, scales):
+        """Atomically replace the store file, then swap the new state in memory (caller holds the file lock)"""
+        tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=str), quantized=quantized, scales=scales)
+        os.replace(tmp_path, self.store_path)
+
+        self._set(names, quantized, scales)
+        self._stat = self._store_stat()
+        self._build_tree()
+
+# Global encoding store instance
+encoding_store = EncodingStore()
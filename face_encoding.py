@@ -0,0 +1,152 @@
+"""
+Image decoding and face encoding for the web dashboard.
+
+These functions run in the dashboard's encoding worker processes. Spawned
+workers import this module, so it must not do any work at import time beyond
+loading the face recognition models.
+"""
+
+import io
+import numpy as np
+import dlib
+import face_recognition
+from face_recognition import api as face_recognition_api
+from PIL import Image
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TJ = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, RuntimeError, OSError):
+    # PyTurboJPEG or the libturbojpeg library is missing, decode with PIL
+    TURBOJPEG_AVAILABLE = False
+
+# Largest side (in pixels) of images passed to the face encoder; the encoding
+# is 128-d regardless of input size, so larger images only cost time
+MAX_ENCODE_SIZE = 800
+
+# Refuse to decode images larger than 40 megapixels (decompression bombs).
+# PIL only raises above twice its MAX_IMAGE_PIXELS and merely warns below
+# that, so both decode paths also check against this limit themselves
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+def _check_image_size(width, height):
+    """Raise ValueError for images above MAX_IMAGE_PIXELS"""
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image of {width}x{height} pixels is too large")
+
+# dlib built with CUDA runs face detection and encoding on the GPU
+DLIB_USE_CUDA = bool(getattr(dlib, 'DLIB_USE_CUDA', False))
+
+def _decode_jpeg_turbo(image_bytes):
+    """Decode a JPEG with libjpeg-turbo, using DCT scaling to get close to MAX_ENCODE_SIZE"""
+    width, height = _TJ.decode_header(image_bytes)[:2]
+    _check_image_size(width, height)
+    
+    # Largest reduction that keeps the longest side at or above MAX_ENCODE_SIZE
+    scaling_factor = (1, 1)
+    for denominator in (2, 4, 8):
+        if max(width, height) // denominator < MAX_ENCODE_SIZE:
+            break
+        scaling_factor = (1, denominator)
+    return _TJ.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+
+def decode_image(image_bytes):
+    """Decode image bytes into an RGB array no larger than MAX_ENCODE_SIZE"""
+    if TURBOJPEG_AVAILABLE and image_bytes[:2] == b'\xff\xd8':
+        image_array = _decode_jpeg_turbo(image_bytes)
+        if max(image_array.shape[:2]) <= MAX_ENCODE_SIZE:
+            return image_array
+        image = Image.fromarray(image_array)
+    else:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Image.open only reads the header, so this runs before any pixel is decoded
+        _check_image_size(*image.size)
+    # Downscale before decoding fully (JPEG is decoded at reduced scale)
+    image.thumbnail((MAX_ENCODE_SIZE, MAX_ENCODE_SIZE), Image.BILINEAR)
+    return np.asarray(image.convert('RGB'))
+
+def _locate_faces(image_arrays):
+    """
+    Find the face locations in each image. With a CUDA build of dlib the CNN
+    detector runs on the GPU in batches, one batch per distinct image size
+    (the batched detector needs equally sized images); otherwise HOG is used.
+    """
+    if not DLIB_USE_CUDA:
+        return [face_recognition.face_locations(image_array) for image_array in image_arrays]
+    
+    locations = [None] * len(image_arrays)
+    indices_by_shape = {}
+    for index, image_array in enumerate(image_arrays):
+        indices_by_shape.setdefault(image_array.shape, []).append(index)
+    
+    for indices in indices_by_shape.values():
+        batch_locations = face_recognition.batch_face_locations(
+            [image_arrays[index] for index in indices],
+            number_of_times_to_upsample=0,
+            batch_size=len(indices)
+        )
+        for index, face_locations in zip(indices, batch_locations):
+            locations[index] = face_locations
+    return locations
+
+def encode_faces(image_arrays, batch_size=16):
+    """
+    Compute face encodings for several images at once.
+    
+    Faces are located (in GPU batches when available) and aligned per image,
+    then the ResNet descriptors are computed through dlib's batched
+    compute_face_descriptor, batch_size images per call. Returns one list of
+    128-d encodings per input image.
+    """
+    results = []
+    for start in range(0, len(image_arrays), batch_size):
+        batch = image_arrays[start:start + batch_size]
+        batch_shapes = []
+        for image_array, face_locations in zip(batch, _locate_faces(batch)):
+            shapes = dlib.full_object_detections()
+            for top, right, bottom, left in face_locations:
+                face_rect = dlib.rectangle(left, top, right, bottom)
+                shapes.append(face_recognition_api.pose_predictor_5_point(image_array, face_rect))
+            batch_shapes.append(shapes)
+        
+        batch_descriptors = face_recognition_api.face_encoder.compute_face_descriptor(batch, batch_shapes, 1)
+        for descriptors in batch_descriptors:
+            results.append([np.array(descriptor) for descriptor in descriptors])
+    return results
+
+def encode_image(image_bytes):
+    """Decode image bytes and return the encodings of all faces in it (runs in the worker pool)"""
+    return encode_faces([decode_image(image_bytes)])[0]
+
+def encode_images(images_bytes):
+    """
+    Decode several images and return the encodings of all faces in each, or
+    None for images that fail to decode (runs in the worker pool)
+    """
+    image_arrays = []
+    decoded = []
+    for image_bytes in images_bytes:
+        try:
+            image_arrays.append(decode_image(image_bytes))
+            decoded.append(True)
+        except Exception as e:
+            print(f"Error decoding image: {e}")
+            decoded.append(False)
+    
+    face_encodings = iter(encode_faces(image_arrays))
+    return [next(face_encodings) if ok else None for ok in decoded]
+
+def warm_up_face_models():
+    """
+    Run the face detector, landmark model and encoder once on a blank image so
+    dlib's weights are touched before the first request. The detector is the
+    one _locate_faces uses, i.e. the CNN detector on CUDA builds of dlib.
+    """
+    try:
+        blank = np.zeros((160, 160, 3), dtype=np.uint8)
+        _locate_faces([blank])
+        # A blank image has no faces, so pass a location to force the encoder to run
+        face_recognition.face_encodings(blank, known_face_locations=[(0, 159, 159, 0)])
+    except Exception as e:
+        print(f"Warning: Failed to warm up face recognition models: {e}")
@@ -19,6 +19,7 @@ except ImportError:
     GPIO_AVAILABLE = False
 
 from database import db_manager
+from encoding_store import encoding_store
 
 # Global queue for text-to-speech greetings
 global_greeting_queue = queue.Queue()
@@ -219,40 +220,15 @@ def main():
         logger.log_event("Error", "Cannot open webcam")
         sys.exit(1)
     
-    # Create arrays of known face encodings and their names
-    known_face_encodings = []
-    known_face_names = []
+    # Known face encodings come from the shared int8 encoding matrix
     greeted_this_session = set() # Set to track who has been greeted
     
-    # Define allowed image extensions
-    image_extensions = ('.jpg', '.jpeg', '.png')
-    known_faces_dir = 'known_faces'
-    
     print("Loading known faces...")
-    # Load sample pictures and learn how to recognize them.
-    if os.path.exists(known_faces_dir):
-        for image_file in os.listdir(known_faces_dir):
-            if image_file.lower().endswith(image_extensions) and not image_file.endswith('_encoding.npy'):
-                # Skip individual face images, only load encoding files
-                continue
-            if image_file.endswith('_encoding.npy'):
-                try:
-                    # Extract name from encoding file name
-                    name = image_file.replace('_encoding.npy', '')
-                    print(f" > Loading encoding for {name}...")
-                    
-                    # Load precomputed encoding
-                    encoding_file = os.path.join(known_faces_dir, image_file)
-                    image_face_encoding = np.load(encoding_file)
-                    
-                    known_face_encodings.append(image_face_encoding)
-                    known_face_names.append(name)
-                except Exception as e:
-                    print(f"   Error loading encoding {image_file}: {e}")
-    else:
-        print(f"Warning: Directory '{known_faces_dir}' not found. No known faces will be loaded.")
+    known_face_names = list(encoding_store.names)
+    for name in known_face_names:
+        print(f" > Loaded encoding for {name}")
     
-    if not known_face_encodings:
+    if len(known_face_names) == 0:
         print("\nWarning: No known faces were loaded. The system will only detect 'Unknown' faces.")
         print("Please add images to the 'known_faces' directory using register.py\n")
     
@@ -266,6 +242,7 @@ def main():
     last_unknown_capture_time = 0  # To track when we last captured an unknown person
     last_unknown_face_encoding = None  # To track encoding of last unknown person
     unknown_face_tolerance = 0.6  # Tolerance for comparing unknown faces
+    known_face_tolerance = 0.6  # Tolerance for matching registered faces
     
     try:
         while True:
@@ -295,12 +272,10 @@ def main():
                 face_names = []
                 for face_encoding in face_encodings:
                     name = "Unknown"
-                    if known_face_encodings:
-                        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-                        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-                        best_match_index = np.argmin(face_distances)
-                        if matches[best_match_index]:
-                            name = known_face_names[best_match_index]
+                    if len(known_face_names) > 0:
+                        best_match_name, best_match_distance = encoding_store.query(face_encoding, k=1)[0]
+                        if best_match_distance <= known_face_tolerance:
+                            name = best_match_name
                     
                     face_names.append(name)
                     
@@ -8,6 +8,7 @@ import os
 import sqlite3
 from datetime import datetime
 from database import db_manager
+from encoding_store import encoding_store
 
 def migrate_users():
     """Migrate existing users from known_faces directory to database"""
@@ -19,18 +20,16 @@ def migrate_users():
     
     migrated_count = 0
     
-    # Get all encoding files
-    for file in os.listdir(known_faces_dir):
-        if file.endswith('_encoding.npy'):
-            # Extract username from filename
-            username = file.replace('_encoding.npy', '')
-            
-            # Add user to database
-            if db_manager.add_user(username):
-                print(f"Migrated user: {username}")
-                migrated_count += 1
-            else:
-                print(f"User {username} already exists in database")
+    # Every user with a stored encoding (older per-user encoding files are
+    # migrated into the encoding store when it loads)
+    encoding_store.refresh()
+    for username in encoding_store.names:
+        # Add user to database
+        if db_manager.add_user(username):
+            print(f"Migrated user: {username}")
+            migrated_count += 1
+        else:
+            print(f"User {username} already exists in database")
     
     print(f"Migrated {migrated_count} users to database")
 
@@ -6,6 +6,7 @@ import time
 from datetime import datetime
 import numpy as np
 from database import db_manager
+from encoding_store import encoding_store
 
 def capture_user_images(name, num_images=3):
     """
@@ -93,11 +94,10 @@ def encode_user_faces(name):
     # Calculate the average encoding
     avg_encoding = np.mean(encodings, axis=0)
     
-    # Save the average encoding as a numpy array
-    encoding_path = os.path.join('known_faces', f"{name}_encoding.npy")
-    np.save(encoding_path, avg_encoding)
+    # Save the average encoding into the shared encoding matrix
+    encoding_store.add(name, avg_encoding)
     
-    print(f"Average face encoding saved as {encoding_path}")
+    print(f"Average face encoding saved for {name} in {encoding_store.store_path}")
     return True
 
 def register_user():
@@ -115,7 +115,7 @@ def register_user():
     
     # Check if user already exists
     existing_files = [f for f in os.listdir('known_faces') if f.startswith(f"{name}_") and (f.endswith('.jpg') or f.endswith('_encoding.npy'))]
-    if existing_files:
+    if existing_files or name in encoding_store:
         response = input(f"User {name} already exists with {len(existing_files)} files. Overwrite? (y/n): ").strip().lower()
         if response != 'y':
             print("Registration cancelled")
@@ -123,6 +123,7 @@ def register_user():
         # Delete existing files
         for file in existing_files:
             os.remove(os.path.join('known_faces', file))
+        encoding_store.remove(name)
     
     # Capture user images
     num_images = input("How many images to capture? (default: 3): ").strip()
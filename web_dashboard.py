@@ -1,25 +1,120 @@
 import os
 import json
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response
 import csv
 from datetime import datetime
 from database import db_manager
-import face_recognition
-import numpy as np
+from encoding_store import encoding_store
+from face_encoding import DLIB_USE_CUDA, encode_image, encode_images, warm_up_face_models
 import base64
-import io
-from PIL import Image
 import traceback
+import threading
+import multiprocessing
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 app = Flask(__name__)
 
 # Configure maximum file upload size (16MB)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+def jresp(obj, status=200):
+    """Build a JSON response, serialized with orjson when it is installed"""
+    if ORJSON_AVAILABLE:
+        return app.response_class(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), status=status, mimetype='application/json')
+    response = jsonify(obj)
+    response.status_code = status
+    return response
+
 # Path configurations
 LOG_FILE = 'door_access.log'
 KNOWN_FACES_DIR = 'known_faces'
 
+# Background writer for captured images, so registration doesn't wait on disk
+# (one small write per registration, so a plain thread is enough; io_uring
+# would need Linux 5.6+ and an async server for no request-visible gain)
+_FILE_WRITER = ThreadPoolExecutor(max_workers=1)
+
+# Image decoding and face encoding run in worker processes so they don't hold
+# the GIL for other requests while PIL and dlib do the heavy lifting. Every
+# gunicorn worker has its own pool, so by default the CPUs are split between
+# the WEB_CONCURRENCY workers. On CUDA builds each worker holds its own copy of
+# the CNN models on the GPU, so one worker is the default there
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+DEFAULT_ENCODING_WORKERS = 1 if DLIB_USE_CUDA else max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+ENCODING_WORKERS = int(os.getenv('ENCODING_WORKERS', DEFAULT_ENCODING_WORKERS))
+ENCODING_TIMEOUT = 30  # seconds
+# Most users per /register_users_bulk request, which waits ENCODING_TIMEOUT per image
+MAX_BULK_USERS = 20
+_encoding_pool = None
+_encoding_pool_lock = threading.Lock()
+
+# Recently computed encodings keyed by a BLAKE2 hash of the uploaded image bytes
+ENCODING_LRU_SIZE = 2048
+_encoding_lru = OrderedDict()
+_encoding_in_flight = {}  # hash -> (pool, future) of an encoding still running in the pool
+_encoding_lru_lock = threading.Lock()
+
+def _get_encoding_pool():
+    """Create the encoding process pool on first use, i.e. after any gunicorn fork"""
+    global _encoding_pool
+    with _encoding_pool_lock:
+        if _encoding_pool is None:
+            if DLIB_USE_CUDA:
+                # A CUDA context doesn't survive fork, so GPU workers are spawned
+                # fresh and warm up their own models
+                _encoding_pool = ProcessPoolExecutor(
+                    max_workers=ENCODING_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_up_face_models
+                )
+            else:
+                _encoding_pool = ProcessPoolExecutor(max_workers=ENCODING_WORKERS)
+        return _encoding_pool
+
+def _discard_encoding_pool(pool):
+    """Drop a pool whose worker died (OOM kill, dlib crash), so the next job starts a fresh one"""
+    global _encoding_pool
+    with _encoding_pool_lock:
+        if _encoding_pool is pool:
+            _encoding_pool = None
+    # A broken pool has already failed its pending jobs, so there is nothing to wait for
+    pool.shutdown(wait=False)
+
+def _submit_encoding(fn, *args):
+    """Submit a job to the encoding pool, replacing the pool once if it is already broken"""
+    pool = _get_encoding_pool()
+    try:
+        return pool, pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _discard_encoding_pool(pool)
+        pool = _get_encoding_pool()
+        return pool, pool.submit(fn, *args)
+
+def _is_user_file(filename, name):
+    """Check whether a known_faces file (image or encoding) belongs to a user"""
+    return filename.startswith(f"{name}_") and (filename.endswith('.jpg') or filename.endswith('_encoding.npy'))
+
+def _user_exists(name):
+    """Check for any image or encoding file of a user, stopping at the first match"""
+    encoding_store.refresh()
+    if name in encoding_store:
+        return True
+    with os.scandir(KNOWN_FACES_DIR) as entries:
+        return any(_is_user_file(entry.name, name) for entry in entries)
+
 @app.route('/')
 def index():
     """Main dashboard page showing registered users"""
@@ -28,9 +123,15 @@ def index():
 
 @app.route('/logs')
 def logs():
-    """API endpoint to get all logs as JSON"""
+    """API endpoint to get all logs as JSON, or as msgpack if the client accepts it"""
     logs = read_access_logs()
-    return jsonify(logs)
+    if MSGPACK_AVAILABLE and request.accept_mimetypes.best_match(['application/json', 'application/msgpack']) == 'application/msgpack':
+        response = Response(msgpack.packb(logs, use_bin_type=True), mimetype='application/msgpack')
+    else:
+        response = jresp(logs)
+    # The body depends on the Accept header, so caches must key on it too
+    response.vary.add('Accept')
+    return response
 
 @app.route('/users')
 def users():
@@ -47,102 +148,230 @@ def register():
 def register_user():
     """API endpoint to register a new user with face capture"""
     try:
-        # Get form data
+        # Get form data; the image comes as a multipart file, or as a base64
+        # data URL form field from older clients
         user_name = request.form.get('name')
+        image_file = request.files.get('image')
         image_data = request.form.get('image')
         
         if not user_name:
-            return jsonify({"status": "error", "message": "User name is required"})
-        
-        if not image_data:
-            return jsonify({"status": "error", "message": "Face image is required"})
+            return jresp({"status": "error", "message": "User name is required"})
         
-        # Create known_faces directory if it doesn't exist
-        if not os.path.exists(KNOWN_FACES_DIR):
-            os.makedirs(KNOWN_FACES_DIR)
+        if not image_file and not image_data:
+            return jresp({"status": "error", "message": "Face image is required"})
         
         # Check if user already exists
-        existing_files = [f for f in os.listdir(KNOWN_FACES_DIR) if f.startswith(f"{user_name}_") and (f.endswith('.jpg') or f.endswith('_encoding.npy'))]
-        if existing_files:
-            return jsonify({"status": "error", "message": f"User {user_name} already exists. Please choose a different name or delete the existing user."})
+        if _user_exists(user_name):
+            return jresp({"status": "error", "message": f"User {user_name} already exists. Please choose a different name or delete the existing user."})
         
-        # Save the image directly to known_faces folder
+        # Decode the image in memory; it is only saved once encoding succeeds
         try:
-            # Remove data URL prefix if present
-            if image_data.startswith('data:image'):
-                image_data = image_data.split(',')[1]
+            if image_file:
+                image_bytes = image_file.read()
+            else:
+                # Remove data URL prefix if present
+                if image_data.startswith('data:image'):
+                    image_data = image_data.split(',')[1]
+                
+                # Decode base64 image data
+                image_bytes = base64.b64decode(image_data)
             
-            # Decode base64 image data
-            image_bytes = base64.b64decode(image_data)
+            if not image_bytes:
+                return jresp({"status": "error", "message": "Face image is required"})
             
-            # Save image file directly (single image)
-            image_path = os.path.join(KNOWN_FACES_DIR, f"{user_name}_1.jpg")
-            with open(image_path, "wb") as f:
-                f.write(image_bytes)
+            # Decode and encode in the worker pool; the full-resolution bytes
+            # are still what gets archived
+            face_encodings = encode_image_bytes(image_bytes)
             
-            # Generate face encoding immediately
-            if generate_single_user_encoding(user_name):
+            # Save the face encoding immediately
+            if generate_single_user_encoding(user_name, face_encodings):
+                # Keep the captured image for reference without blocking the response
+                image_path = os.path.join(KNOWN_FACES_DIR, f"{user_name}_1.jpg")
+                _queue_file_write(image_path, image_bytes)
+                
                 # Add user to database
                 db_manager.add_user(user_name)
-                return jsonify({"status": "success", "message": f"User {user_name} registered successfully with face capture."})
+                return jresp({"status": "success", "message": f"User {user_name} registered successfully with face capture."})
             else:
-                # Clean up the saved image if encoding fails
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-                return jsonify({"status": "error", "message": "Failed to generate face encoding. Please ensure a clear face image with good lighting."})
+                return jresp({"status": "error", "message": "Failed to generate face encoding. Please ensure a clear face image with good lighting."})
                 
+        except FutureTimeoutError:
+            return jresp({"status": "error", "message": f"Face encoding timed out after {ENCODING_TIMEOUT} seconds. Please try again."})
+        except BrokenProcessPool:
+            return jresp({"status": "error", "message": "Face encoding worker stopped unexpectedly. Please try again."})
         except Exception as e:
-            return jsonify({"status": "error", "message": f"Failed to save face image: {str(e)}"})
+            return jresp({"status": "error", "message": f"Failed to process face image: {str(e)}"})
     except Exception as e:
-        return jsonify({"status": "error", "message": f"Failed to register user: {str(e)}"})
+        return jresp({"status": "error", "message": f"Failed to register user: {str(e)}"})
 
-def generate_single_user_encoding(name):
-    """
-    Generate face encoding for a user from a single captured image
-    """
+@app.route('/register_users_bulk', methods=['POST'])
+def register_users_bulk():
+    """API endpoint to register several users at once from a JSON list of {name, image} objects"""
     try:
-        # Look for the single image file
-        image_file = f"{name}_1.jpg"
-        image_path = os.path.join(KNOWN_FACES_DIR, image_file)
-        
-        if not os.path.exists(image_path):
-            print(f"Error: Image file not found for user {name}")
-            return False
+        entries = request.get_json(silent=True)
+        if not isinstance(entries, list) or not entries:
+            return jresp({"status": "error", "message": "Expected a JSON list of {name, image} objects"})
+        if len(entries) > MAX_BULK_USERS:
+            return jresp({"status": "error", "message": f"At most {MAX_BULK_USERS} users can be registered at once"})
         
-        try:
-            # Load image with PIL first to ensure it's valid
-            image = Image.open(image_path)
-            image = image.convert('RGB')  # Ensure RGB format
-            image_array = np.array(image)
-            
-            # Then process with face_recognition
-            face_encodings = face_recognition.face_encodings(image_array)
-            
-            if len(face_encodings) == 0:
-                print(f"Warning: No faces found in {image_file}.")
-                return False
-            elif len(face_encodings) > 1:
-                print(f"Warning: Multiple faces found in {image_file}. Using the first one.")
+        results = []
+        pending = []  # (result, image_bytes) for entries that passed validation
+        seen_names = set()
+        for entry in entries:
+            entry = entry if isinstance(entry, dict) else {}
+            user_name = entry.get('name')
+            image_data = entry.get('image')
+            result = {"name": user_name, "status": "error"}
+            results.append(result)
             
-            # Use the first face encoding
-            encoding = face_encodings[0]
+            if not user_name or not isinstance(user_name, str):
+                result["message"] = "User name is required"
+            elif not image_data or not isinstance(image_data, str):
+                result["message"] = "Face image is required"
+            elif user_name in seen_names or _user_exists(user_name):
+                result["message"] = f"User {user_name} already exists"
+            else:
+                seen_names.add(user_name)
+                try:
+                    if image_data.startswith('data:image'):
+                        image_data = image_data.split(',')[1]
+                    pending.append((result, base64.b64decode(image_data)))
+                except Exception as e:
+                    result["message"] = f"Failed to decode face image: {str(e)}"
+        
+        # Encode every image through one batched call in the worker pool
+        encodings = {}
+        registered = []  # (result, image_bytes) of users whose face was encoded
+        if pending:
+            images = [image_bytes for _, image_bytes in pending]
+            pool, future = _submit_encoding(encode_images, images)
+            try:
+                batch_encodings = future.result(timeout=ENCODING_TIMEOUT * len(images))
+            except FutureTimeoutError:
+                return jresp({"status": "error", "message": f"Face encoding timed out after {ENCODING_TIMEOUT * len(images)} seconds. Please try again with fewer users."})
+            except BrokenProcessPool:
+                _discard_encoding_pool(pool)
+                return jresp({"status": "error", "message": "Face encoding worker stopped unexpectedly. Please try again."})
             
-            # Save the encoding as a numpy array
-            encoding_path = os.path.join(KNOWN_FACES_DIR, f"{name}_encoding.npy")
-            np.save(encoding_path, encoding)
+            for (result, image_bytes), face_encodings in zip(pending, batch_encodings):
+                if face_encodings is None:
+                    result["message"] = "Failed to process face image"
+                elif len(face_encodings) == 0:
+                    result["message"] = "No face found. Please ensure a clear face image with good lighting."
+                else:
+                    encodings[result["name"]] = face_encodings[0]
+                    registered.append((result, image_bytes))
+        
+        # Save all encodings at once and add all users in a single transaction;
+        # users only count as registered (and their images are kept) once both succeed
+        if encodings:
+            encoding_store.add_many(encodings)
+            try:
+                added = db_manager.add_users(list(encodings))
+            except Exception:
+                # Undo the encodings, so a retry doesn't find every user "already exists"
+                encoding_store.remove_many(list(encodings))
+                raise
             
-            print(f"Face encoding saved as {encoding_path}")
-            return True
-        except Exception as e:
-            print(f"Error processing image {image_file}: {e}")
-            traceback.print_exc()
+            for (result, image_bytes), new_user in zip(registered, added):
+                image_path = os.path.join(KNOWN_FACES_DIR, f"{result['name']}_1.jpg")
+                _queue_file_write(image_path, image_bytes)
+                result["status"] = "success"
+                if new_user:
+                    result["message"] = f"User {result['name']} registered successfully with face capture."
+                else:
+                    # The user was already in the database (e.g. added without a face)
+                    result["message"] = f"Face capture added for existing user {result['name']}."
+        
+        return jresp({"status": "success", "message": f"Registered {len(encodings)} of {len(entries)} users.", "results": results})
+    except Exception as e:
+        return jresp({"status": "error", "message": f"Failed to register users: {str(e)}"})
+
+def _cache_encoding(image_hash, future):
+    """Store a finished encoding in the LRU, even if the request that submitted it timed out"""
+    with _encoding_lru_lock:
+        _encoding_in_flight.pop(image_hash, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        _encoding_lru[image_hash] = future.result()
+        if len(_encoding_lru) > ENCODING_LRU_SIZE:
+            _encoding_lru.popitem(last=False)
+
+def encode_image_bytes(image_bytes):
+    """
+    Get the face encodings of an uploaded image, reusing the result when the
+    same bytes were uploaded before. An encoding that is still running (e.g.
+    after the client's earlier request timed out) is waited on instead of
+    being started again, and is cached once it finishes.
+    """
+    image_hash = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    with _encoding_lru_lock:
+        if image_hash in _encoding_lru:
+            _encoding_lru.move_to_end(image_hash)
+            return _encoding_lru[image_hash]
+        in_flight = _encoding_in_flight.get(image_hash)
+        if in_flight is None:
+            in_flight = _submit_encoding(encode_image, image_bytes)
+            _encoding_in_flight[image_hash] = in_flight
+            submitted = True
+        else:
+            submitted = False
+    
+    pool, future = in_flight
+    if submitted:
+        # Added outside the lock: the callback runs right away if the future is already done
+        future.add_done_callback(lambda done: _cache_encoding(image_hash, done))
+    try:
+        return future.result(timeout=ENCODING_TIMEOUT)
+    except BrokenProcessPool:
+        _discard_encoding_pool(pool)
+        raise
+
+def generate_single_user_encoding(name, face_encodings):
+    """
+    Save the face encoding for a user from the encodings found in a single captured image
+    """
+    try:
+        if len(face_encodings) == 0:
+            print(f"Warning: No faces found in the image for {name}.")
             return False
+        elif len(face_encodings) > 1:
+            print(f"Warning: Multiple faces found in the image for {name}. Using the first one.")
         
+        # Use the first face encoding
+        encoding = face_encodings[0]
+        
+        # Save the encoding into the shared encoding matrix
+        encoding_store.add(name, encoding)
+        
+        print(f"Face encoding saved for {name} in {encoding_store.store_path}")
+        return True
     except Exception as e:
         print(f"Error generating encoding: {e}")
         traceback.print_exc()
         return False
 
+def _write_file(path, data):
+    """Write bytes to a file (run on the background file writer)"""
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _report_write_error(future):
+    """Print the error of a failed background write, which nothing else waits on"""
+    if future.exception() is not None:
+        print(f"Error saving face image: {future.exception()}")
+
+def _queue_file_write(path, data):
+    """Write a file on the background writer, reporting any failure"""
+    _FILE_WRITER.submit(_write_file, path, data).add_done_callback(_report_write_error)
+
+def _remove_user_files(username):
+    """Delete the image and encoding files of a user (run on the background file writer)"""
+    with os.scandir(KNOWN_FACES_DIR) as entries:
+        for entry in entries:
+            if _is_user_file(entry.name, username):
+                os.remove(entry.path)
+
 @app.route('/add_user', methods=['POST'])
 def add_user():
     """API endpoint to add a new user to the database"""
@@ -151,42 +380,37 @@ def add_user():
         user_name = request.form.get('name')
         
         if not user_name:
-            return jsonify({"status": "error", "message": "User name is required"})
+            return jresp({"status": "error", "message": "User name is required"})
         
         # Check if user already exists
-        if not os.path.exists(KNOWN_FACES_DIR):
-            os.makedirs(KNOWN_FACES_DIR)
-            
-        existing_files = [f for f in os.listdir(KNOWN_FACES_DIR) if f.startswith(f"{user_name}_") and (f.endswith('.jpg') or f.endswith('_encoding.npy'))]
-        if existing_files:
+        if _user_exists(user_name):
             # User already exists, return error
-            return jsonify({"status": "error", "message": f"User {user_name} already exists"})
+            return jresp({"status": "error", "message": f"User {user_name} already exists"})
         
         # Add user to database
         db_manager.add_user(user_name)
         
         # Return success response
-        return jsonify({"status": "success", "message": f"User {user_name} added successfully. Please capture face image for recognition.", "user_name": user_name})
+        return jresp({"status": "success", "message": f"User {user_name} added successfully. Please capture face image for recognition.", "user_name": user_name})
     except Exception as e:
-        return jsonify({"status": "error", "message": f"Failed to add user: {str(e)}"})
+        return jresp({"status": "error", "message": f"Failed to add user: {str(e)}"})
 
 @app.route('/delete_user/<username>')
 def delete_user(username):
     """Delete a registered user"""
     try:
-        # Delete user image and encoding files
-        if os.path.exists(KNOWN_FACES_DIR):
-            for file in os.listdir(KNOWN_FACES_DIR):
-                if file.startswith(f"{username}_") and (file.endswith('.jpg') or file.endswith('_encoding.npy')):
-                    file_path = os.path.join(KNOWN_FACES_DIR, file)
-                    os.remove(file_path)
+        # Delete user image and encoding files on the writer thread, after any
+        # image of the user that is still queued has been written
+        _FILE_WRITER.submit(_remove_user_files, username).result()
+        
+        encoding_store.remove(username)
             
         # Also delete user from database
         db_manager.delete_user(username)
             
-        return jsonify({"status": "success", "message": f"User {username} deleted"})
+        return jresp({"status": "success", "message": f"User {username} deleted"})
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return jresp({"status": "error", "message": str(e)})
 
 def read_access_logs():
     """Read access logs from the database"""
@@ -202,69 +426,42 @@ def read_access_logs():
 
 def get_registered_users():
     """Get list of registered users from database"""
-    db_users = db_manager.get_all_users()
+    encoding_store.refresh()
     users = []
-    user_dict = {}  # Use a dictionary to avoid duplicates
     
-    # First, process users from database
-    for db_user in db_users:
-        user_dict[db_user[1]] = {
+    for db_user in db_manager.get_all_users():
+        users.append({
             'name': db_user[1],
-            'trained': False,  # Will be updated if encoding exists
+            'trained': db_user[1] in encoding_store,
             'created_at': db_user[2],
             'last_seen': db_user[3],
             'access_count': db_user[4]
-        }
-    
-    # Then, check for image files and encodings
-    if os.path.exists(KNOWN_FACES_DIR):
-        encoding_files = [f for f in os.listdir(KNOWN_FACES_DIR) if f.endswith('_encoding.npy')]
-        
-        for file in os.listdir(KNOWN_FACES_DIR):
-            if file.endswith('.jpg') and '_' in file and not file.startswith('.'):
-                # Extract username from filename (before the _number.jpg part)
-                parts = file.split('_')
-                if len(parts) >= 2:
-                    username = '_'.join(parts[:-1])
-                    # Check if encoding file exists
-                    encoding_file = f"{username}_encoding.npy"
-                    trained = encoding_file in encoding_files
-                    
-                    if username in user_dict:
-                        # Update existing user
-                        user_dict[username]['trained'] = trained
-                    else:
-                        # Add new user from image files
-                        user_dict[username] = {
-                            'name': username,
-                            'trained': trained,
-                            'created_at': None,
-                            'last_seen': None,
-                            'access_count': 0
-                        }
-            elif file.endswith('_encoding.npy'):
-                # Handle encoding files directly
-                username = file.replace('_encoding.npy', '')
-                if username not in user_dict:
-                    # Add user from encoding file if not in database
-                    user_dict[username] = {
-                        'name': username,
-                        'trained': True,
-                        'created_at': None,
-                        'last_seen': None,
-                        'access_count': 0
-                    }
-                else:
-                    # Ensure trained status is set correctly
-                    user_dict[username]['trained'] = True
+        })
     
-    # Convert dictionary to list
-    users = list(user_dict.values())
     return users
 
-if __name__ == '__main__':
-    # Create templates directory if it doesn't exist
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
+def reconcile_users():
+    """Add database rows for users that only have a stored encoding (e.g. migrated .npy files)"""
+    db_names = {db_user[1] for db_user in db_manager.get_all_users()}
+    for name in encoding_store.names:
+        if name not in db_names:
+            print(f"Adding user {name} to database from stored encoding")
+            db_manager.add_user(name)
+
+# Spawned encoding workers re-import this module when it is run as a script,
+# so only the serving process sets up directories, users and models
+if multiprocessing.parent_process() is None:
+    # Create the data and template directories once, instead of checking per request
+    os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
+    os.makedirs('templates', exist_ok=True)
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    reconcile_users()
+    
+    # Under gunicorn --preload the models are loaded once in the master and
+    # shared by forked workers; CUDA workers warm up themselves once spawned
+    if not DLIB_USE_CUDA:
+        warm_up_face_models()
+
+if __name__ == '__main__':
+    # Debug mode (auto reload, interactive debugger) is opt-in; use gunicorn in production
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG') == '1')
\ No newline at end of file